@@ -207,6 +207,23 @@ class FileDatasetGenerator(object):
         self.std = np.asarray(std, dtype=np.float32)
     
     
+    def channel_stats(self):
+        """ Provides the channel-wise statistics used for normalizing images.
+
+        Images obtained from a sequence with `normalize=False` can be normalized by subtracting the mean
+        and dividing by the standard deviation.
+
+        # Returns:
+            tuple with two 1-d numpy arrays containing the channel-wise mean and standard deviation,
+            in the channel order of the provided images.
+        """
+
+        if self.color_mode == 'bgr':
+            return self.mean[::-1], self.std[::-1]
+        else:
+            return self.mean, self.std
+    
+    
     def flow_train(self, batch_size = 32, include_labels = True, shuffle = True, target_size = None, augment = True):
         """ A generator yielding batches of pre-processed and augmented training images.
 
@@ -298,7 +315,7 @@ class FileDatasetGenerator(object):
                             batch_transform=batch_transform, batch_transform_kwargs=batch_transform_kwargs)
     
     
-    def test_sequence(self, batch_size = 32, shuffle = False, target_size = None, augment = False, batch_transform = None, batch_transform_kwargs = {}):
+    def test_sequence(self, batch_size = 32, shuffle = False, target_size = None, augment = False, normalize = True, batch_transform = None, batch_transform_kwargs = {}):
         """ Creates a `DataSequence` with pre-processed and augmented test images that can be passed to the Keras methods expecting a generator for efficient and safe multi-processing.
 
         # Arguments:
@@ -314,6 +331,9 @@ class FileDatasetGenerator(object):
         
         - augment: Whether data augmentation should be applied or not.
 
+        - normalize: If False, images will not be normalized, so that they contain the original (integral) pixel values.
+                     The statistics for normalizing them can be obtained from `channel_stats()`.
+
         - batch_transform: Optionally, a function that takes the inputs and targets of a batch and returns
                            transformed inputs and targets that will be provided by the sequence instead of
                            the original ones.
@@ -326,7 +346,7 @@ class FileDatasetGenerator(object):
 
         return DataSequence(self, self.test_img_files, self._test_labels,
                             batch_size=batch_size, shuffle=shuffle,
-                            target_size=target_size, normalize=True, hflip=augment, vflip=False, colordistort=False,
+                            target_size=target_size, normalize=normalize, hflip=augment, vflip=False, colordistort=False,
                             randzoom=augment, randrot=augment, cropsize=self.cropsize, randcrop=augment, randerase=augment,
                             batch_transform=batch_transform, batch_transform_kwargs=batch_transform_kwargs)
     
@@ -742,7 +762,7 @@ class TinyDatasetGenerator(object):
                             batch_size=batch_size, shuffle=shuffle, batch_transform=batch_transform, batch_transform_kwargs=batch_transform_kwargs)
     
     
-    def test_sequence(self, batch_size = 32, shuffle = False, augment = False, batch_transform = None, batch_transform_kwargs = {}):
+    def test_sequence(self, batch_size = 32, shuffle = False, augment = False, normalize = True, batch_transform = None, batch_transform_kwargs = {}):
         """ Creates a `DataSequence` with pre-processed and augmented test images that can be passed to the Keras methods expecting a generator for efficient and safe multi-processing.
 
         # Arguments:
@@ -753,6 +773,9 @@ class TinyDatasetGenerator(object):
         
         - augment: Whether data augmentation should be applied or not.
 
+        - normalize: If False, images will not be standardized, so that they contain the original pixel values.
+                     The statistics for normalizing them can be obtained from `channel_stats()`.
+
         - batch_transform: Optionally, a function that takes the inputs and targets of a batch and returns
                            transformed inputs and targets that will be provided by the sequence instead of
                            the original ones.
@@ -764,11 +787,11 @@ class TinyDatasetGenerator(object):
         """
         
         return DataSequence(self, np.arange(len(self.X_test)), self.y_test,
-                            train=False, augment=augment,
+                            train=False, augment=augment, normalize=normalize,
                             batch_size=batch_size, shuffle=shuffle, batch_transform=batch_transform, batch_transform_kwargs=batch_transform_kwargs)
     
 
-    def compose_batch(self, indices, train, augment = False):
+    def compose_batch(self, indices, train, augment = False, normalize = True):
         """ Composes a batch of augmented images given by their indices.
 
         # Arguments:
@@ -779,6 +802,8 @@ class TinyDatasetGenerator(object):
 
         - augment: Whether data augmentation should be applied or not.
 
+        - normalize: Whether images should be standardized or not.
+
         # Returns:
             a batch of images as 4-dimensional numpy array.
         """
@@ -790,10 +815,36 @@ class TinyDatasetGenerator(object):
         for i, j in enumerate(indices):
             x = X[j]
             x = image_generator.random_transform(x.astype(K.floatx()))
-            x = image_generator.standardize(x)
+            if normalize:
+                x = image_generator.standardize(x)
             batch[i] = x
         
         return batch
+
+
+    def channel_stats(self):
+        """ Provides the channel-wise statistics used for normalizing images.
+
+        Images obtained from a sequence with `normalize=False` can be normalized by subtracting the mean
+        and dividing by the standard deviation.
+
+        # Returns:
+            tuple with two 1-d numpy arrays containing the channel-wise mean and standard deviation.
+
+        # Raises:
+            ValueError: if the images are standardized in a way that cannot be expressed by channel-wise statistics.
+        """
+
+        image_generator = self.test_image_generator
+        if image_generator.preprocessing_function or image_generator.rescale or image_generator.zca_whitening \
+                or image_generator.samplewise_center or image_generator.samplewise_std_normalization:
+            raise ValueError('The standardization of this dataset cannot be expressed by channel-wise statistics.')
+        
+        num_channels = self.X_train.shape[image_generator.channel_axis]
+        mean = np.ravel(image_generator.mean) if image_generator.featurewise_center else np.zeros(num_channels)
+        # ImageDataGenerator adds this constant to the standard deviation
+        std = np.ravel(image_generator.std) + 1e-6 if image_generator.featurewise_std_normalization else np.ones(num_channels)
+        return mean.astype(np.float32), std.astype(np.float32)
     
 
     @property
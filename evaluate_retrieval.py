@@ -13,6 +13,11 @@ except ImportError:
     def tqdm(it, **kwargs):
         return it
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
 
 
 METRICS = ['P@1 (WUP)', 'P@10 (WUP)', 'P@50 (WUP)', 'P@100 (WUP)', 'AHP (WUP)', 'P@1 (LCS_HEIGHT)', 'P@10 (LCS_HEIGHT)', 'P@50 (LCS_HEIGHT)', 'P@100 (LCS_HEIGHT)', 'AHP (LCS_HEIGHT)', 'AP']
@@ -28,6 +33,8 @@ def pairwise_retrieval(features, normalize = False, return_generator = True):
                 - 2-d numpy array with each row corresponding to a sample.
                 - Dictionary mapping image IDs to feature vectors.
                 - Path to a pickle file containing such a dictionary.
+                - Path to an HDF5 file with a dataset "feat" containing the feature matrix and, optionally,
+                  a dataset "index" containing the image IDs corresponding to its rows.
     
     - normalize: Whether to L2-normalize the features.
 
@@ -40,9 +47,19 @@ def pairwise_retrieval(features, normalize = False, return_generator = True):
     """
     
     # Convert feature list to numpy array
+    ind2id = None
     if isinstance(features, str):
-        with open(features, 'rb') as feat_dump:
-            features = pickle.load(feat_dump)
+        if (h5py is not None) and h5py.is_hdf5(features):
+            with h5py.File(features, 'r') as feat_dump:
+                if 'index' in feat_dump:
+                    ind2id = feat_dump['index'][()]
+                features = feat_dump['feat'][()].astype(np.float32)
+        else:
+            with open(features, 'rb') as feat_dump:
+                if feat_dump.read(8) == b'\x89HDF\r\n\x1a\n':
+                    raise ImportError('h5py is required for reading HDF5 feature dumps.')
+                feat_dump.seek(0)
+                features = pickle.load(feat_dump)
     if isinstance(features, dict):
         if 'feat' in features:
             features = features['feat']
@@ -50,8 +67,6 @@ def pairwise_retrieval(features, normalize = False, return_generator = True):
         features = np.stack(list(features.values()))
         if features.ndim > 2:
             raise ValueError('Feature matrix must be 2-dimensional. Actual shape: {}'.format(features.shape))
-    else:
-        ind2id = None
     
     # Compute pairwise distances
     if normalize:
@@ -163,7 +178,7 @@ if __name__ == '__main__':
     arggroup.add_argument('--str_ids', action = 'store_true', default = False, help = 'If given, class IDs are treated as strings instead of integers.')
     arggroup.add_argument('--classes_from', type = str, default = None, help = 'Optionally, a path to a pickle dump containing a dictionary with item "ind2label" specifying the classes to be considered.')
     arggroup = parser.add_argument_group('Features')
-    arggroup.add_argument('--feat', type = str, action = 'append', required = True, help = 'Pickle file containing a dictionary mapping image IDs to features.')
+    arggroup.add_argument('--feat', type = str, action = 'append', required = True, help = 'HDF5 file with a feature matrix or pickle file containing a dictionary mapping image IDs to features.')
     arggroup.add_argument('--label', type = str, action = 'append', help = 'Label for the corresponding features.')
     arggroup.add_argument('--norm', type = str2bool, action = 'append', help = 'Whether to L2-normalize the corresponding features or not (defaults to False).')
     arggroup = parser.add_argument_group('Output')
@@ -43,7 +43,7 @@ def center_loss_model(base_model, centroids):
 
 def transform_inputs(X, y, num_classes):
     
-    return [X, y], [keras.utils.to_categorical(y, num_classes), np.zeros(len(X))]
+    return [X, y], [y, np.zeros(len(X))]
 
 
 
@@ -135,7 +135,7 @@ if __name__ == '__main__':
                 layer.trainable = (layer.name in ('embedding', 'embedding_bn', 'prob', 'cls_centroids'))
             embed_model.layers[-1].trainable = True
             par_model.compile(optimizer = keras.optimizers.SGD(lr=args.sgd_lr, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad),
-                            loss = { 'prob' : 'categorical_crossentropy', 'center_loss' : lambda y_true, y_pred: y_pred },
+                            loss = { 'prob' : 'sparse_categorical_crossentropy', 'center_loss' : lambda y_true, y_pred: y_pred },
                             loss_weights = { 'prob' : 1.0, 'center_loss' : args.center_loss_weight },
                             metrics = { 'prob' : 'accuracy' })
             par_model.fit_generator(
@@ -160,7 +160,7 @@ if __name__ == '__main__':
     else:
         decay = 0.0
     par_model.compile(optimizer = keras.optimizers.SGD(lr=args.sgd_lr, decay=decay, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad),
-                      loss = { 'prob' : 'categorical_crossentropy', 'center_loss' : lambda y_true, y_pred: y_pred },
+                      loss = { 'prob' : 'sparse_categorical_crossentropy', 'center_loss' : lambda y_true, y_pred: y_pred },
                       loss_weights = { 'prob' : 1.0, 'center_loss' : args.center_loss_weight },
                       metrics = { 'prob' : 'accuracy' })
 
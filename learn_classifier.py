@@ -16,10 +16,13 @@ from datasets import get_data_generator
 
 def transform_inputs(X, y, num_classes, label_smoothing = 0):
     
-    Y = keras.utils.to_categorical(y, num_classes)
     if (label_smoothing > 0) and (label_smoothing < 1):
+        Y = keras.utils.to_categorical(y, num_classes)
         Y = Y * (1 - label_smoothing) + (1 - Y) * (label_smoothing / (num_classes - 1))
-    return X, Y
+        return X, Y
+    else:
+        # Without label smoothing, class indices are passed on as they are and a sparse loss is used
+        return X, y
 
 
 
@@ -100,10 +103,12 @@ if __name__ == '__main__':
         model.summary()
     
     batch_transform_kwargs = { 'num_classes' : data_generator.num_classes, 'label_smoothing' : args.label_smoothing }
+    sparse_labels = not ((args.label_smoothing > 0) and (args.label_smoothing < 1))
+    loss = 'sparse_categorical_crossentropy' if sparse_labels else 'categorical_crossentropy'
     metrics = ['accuracy']
     if len(args.top_k_acc) > 0:
         for k in args.top_k_acc:
-            metrics.append(utils.top_k_acc(k))
+            metrics.append(utils.top_k_acc(k, sparse = sparse_labels))
     
     # Load pre-trained weights and train last layer for a few epochs
     if args.finetune:
@@ -114,7 +119,7 @@ if __name__ == '__main__':
             for layer in model.layers[:-1]:
                 layer.trainable = False
             par_model.compile(optimizer = keras.optimizers.SGD(lr=args.sgd_lr, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad),
-                              loss = 'categorical_crossentropy', metrics = metrics)
+                              loss = loss, metrics = metrics)
             par_model.fit_generator(
                     data_generator.train_sequence(args.batch_size, batch_transform = transform_inputs, batch_transform_kwargs = batch_transform_kwargs),
                     validation_data = data_generator.test_sequence(args.val_batch_size, batch_transform = transform_inputs, batch_transform_kwargs = batch_transform_kwargs),
@@ -144,7 +149,7 @@ if __name__ == '__main__':
     else:
         decay = 0.0
     par_model.compile(optimizer = keras.optimizers.SGD(lr=args.sgd_lr, decay=decay, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad),
-                      loss = 'categorical_crossentropy', metrics = metrics)
+                      loss = loss, metrics = metrics)
 
 
     par_model.fit_generator(
@@ -3,15 +3,24 @@ import numpy as np
 import argparse
 import pickle
 import os
+import json
+import hashlib
 import shutil
+import threading
+import h5py
 
+import tensorflow as tf
 import keras
 from keras import backend as K
 
 import utils
+import streaming_metrics
 from datasets import get_data_generator
 
 
+# Keras 2.11 introduced new optimizers, which do not support `decay` anymore, but kept the previous ones as legacy optimizers.
+SGD = tf.keras.optimizers.legacy.SGD if hasattr(tf.keras.optimizers, 'legacy') else keras.optimizers.SGD
+
 
 def cls_model(embed_model, num_classes, cls_base = None):
     """ Appends a classifier to an embedding model.
@@ -40,14 +49,250 @@ def cls_model(embed_model, num_classes, cls_base = None):
             base = embed_model.get_layer(cls_base).output
     
     x = keras.layers.Activation('relu')(base)
-    x = keras.layers.BatchNormalization()(x)
-    x = keras.layers.Dense(num_classes, activation = 'softmax', kernel_regularizer = keras.regularizers.l2(5e-4), name = 'prob')(x)
+    if K.ndim(x) == 2:
+        # The fused batch normalization kernel is only available for 4-d inputs
+        x = keras.layers.Reshape((1, 1, -1))(x)
+        x = keras.layers.BatchNormalization(axis = -1, fused = True)(x)
+        x = keras.layers.Reshape((-1,))(x)
+    else:
+        x = keras.layers.BatchNormalization(fused = True)(x)
+    # Always compute the classifier in float32 for numerical stability of the softmax, even in mixed precision mode.
+    x = keras.layers.Dense(num_classes, activation = 'softmax', kernel_regularizer = keras.regularizers.l2(5e-4), dtype = 'float32', name = 'prob')(x)
     return keras.models.Model(embed_model.inputs, [embed_model.output, x])
 
 
-def transform_inputs(X, y, embedding, num_classes = None):
+def test_labels_digest(data_generator):
+    """ Computes a hash of the class indices of the test images.
+
+    Class indices depend on the order of the classes in the embedding, so the hash can be used to detect
+    whether cached test data has been created for a different dataset or class list.
+
+    # Arguments:
+
+    - data_generator: The data generator providing the test images.
+
+    # Returns:
+        hexadecimal SHA-1 digest as string.
+    """
+
+    return hashlib.sha1(np.asarray(data_generator.labels_test, dtype = np.int64).tobytes()).hexdigest()
+
+
+def build_tfrecord_cache(data_generator, out_dir, num_shards = 16, batch_size = 100):
+    """ Writes resized and cropped test images and their labels to sharded TFRecord files.
+
+    Image `i` is written to shard `i % num_shards`, so that reading the shards in an interleaved fashion
+    restores the original order of the test images.
+    Images are stored as uint8 before normalization, which is lossless since they still contain integral
+    pixel values at that stage. They must be normalized using `data_generator.channel_stats()` when read.
+    A file `meta.json` with a hash of the class labels (see `test_labels_digest`) is written along with the shards.
+
+    # Arguments:
+
+    - data_generator: The data generator providing the test images.
+
+    - out_dir: The directory where the shards will be written to. It will be created if it does not exist.
+
+    - num_shards: Number of TFRecord files.
+
+    - batch_size: Number of images pre-processed at once while writing the cache.
+    """
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    shard_files = [os.path.join(out_dir, 'shard-{:04d}.tfrecord'.format(i)) for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(fn + '.tmp') for fn in shard_files]
+    
+    sequence = data_generator.test_sequence(batch_size, shuffle = False, normalize = False)
+    num_written = 0
+    for X, y in (sequence[i] for i in range(len(sequence))):
+        for img, lbl in zip(np.clip(np.round(X), 0, 255).astype(np.uint8), y):
+            example = tf.train.Example(features = tf.train.Features(feature = {
+                'img'   : tf.train.Feature(bytes_list = tf.train.BytesList(value = [img.tobytes()])),
+                'shape' : tf.train.Feature(int64_list = tf.train.Int64List(value = list(img.shape))),
+                'label' : tf.train.Feature(int64_list = tf.train.Int64List(value = [int(lbl)]))
+            }))
+            writers[num_written % num_shards].write(example.SerializeToString())
+            num_written += 1
+    
+    # Only move finished shards into place, so that an interrupted run does not leave an incomplete cache behind
+    for writer, fn in zip(writers, shard_files):
+        writer.close()
+        os.rename(fn + '.tmp', fn)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({ 'num_images' : num_written, 'labels_sha1' : test_labels_digest(data_generator) }, f)
+
+
+def build_tf_dataset(data_generator, batch_size, embedding, num_classes = None, train = True, shuffle = None,
+                     num_parallel_calls = tf.data.experimental.AUTOTUNE, prefetch = tf.data.experimental.AUTOTUNE, device = None,
+                     tfrecord_cache = None, cache = None, processes = 0):
+    """ Creates a `tf.data.Dataset` providing batches of images and their target class embeddings.
+
+    Batches are composed by a `DataSequence` obtained from the data generator, which is queried by several threads in parallel,
+    or read from a TFRecord cache of pre-processed test images.
+    Class embeddings are looked up inside of the TensorFlow graph and batches are prefetched, so that data pre-processing
+    overlaps with the computations of the model.
+
+    # Arguments:
+
+    - data_generator: The data generator providing the images.
+
+    - batch_size: Number of images per batch.
+
+    - embedding: 2-d float32 tensor or variable whose rows are class embeddings. It is captured by the dataset,
+                 so the same tensor can be shared among several datasets. If None, class indices will be provided
+                 as targets instead of class embeddings.
+
+    - num_classes: If not None, one-hot encoded labels for this number of classes will be provided as second target
+                   in addition to the class embeddings.
+
+    - train: If True, pre-processed and augmented training images will be provided, otherwise test images.
+
+    - shuffle: Whether to shuffle the order of images after each epoch. Defaults to the value of `train`.
+
+    - num_parallel_calls: Number of batches composed in parallel by threads.
+
+    - prefetch: Number of batches to be prefetched.
+
+    - device: Optionally, the name of a device (e.g., '/gpu:0') which the next batches will be copied to asynchronously
+              while the current one is being processed. Must not be used together with a distribution strategy, which
+              takes care of this itself.
+
+    - tfrecord_cache: Optionally, a directory with pre-processed test images written by `build_tfrecord_cache`,
+                      which will be read instead of loading and pre-processing the original images again.
+                      The cache will be built if the directory does not contain any shards. Can only be used if `train` is False,
+                      since pre-processed images would not be augmented differently in each epoch.
+                      A ValueError is raised if the cache has been built for different class labels.
+
+    - cache: Optionally, the name of a file where the batches will be cached after the first pass over the dataset,
+             so that subsequent passes do not need to load them again. If an empty string is given, batches will be cached
+             in memory. Can only be used if `train` is False for the same reason as `tfrecord_cache`.
+             Images and class indices are cached before the targets are derived from them, so the cache does not depend
+             on `embedding` and `num_classes`. The class indices do, however, depend on the class list used by the
+             data generator, so a hash of the test labels and `batch_size` are appended to the filename. That way, an
+             existing cache file is only re-used for the same labels and batch size, but not if the images change.
+
+    - processes: If greater than 0, batches will be composed by this number of worker processes managed by a
+                 `keras.utils.OrderedEnqueuer` instead of threads. Threads contend for the GIL while pre-processing
+                 and augmenting images in Python code, which can be avoided this way at the cost of copying each batch
+                 from the worker processes. Each pass over the dataset must consume all of its batches in that case.
+
+    # Returns:
+        a tf.data.Dataset yielding tuples of inputs and targets for each batch.
+    """
+
+    if shuffle is None:
+        shuffle = train
+    if (tfrecord_cache is not None) and (train or shuffle):
+        raise ValueError('A TFRecord cache can only provide test images in their original order.')
+    if (cache is not None) and (train or shuffle):
+        raise ValueError('Only test images in their original order can be cached.')
+    
+    image_shape = (None, None, None, data_generator.num_channels) if K.image_data_format() == 'channels_last' else (None, data_generator.num_channels, None, None)
+
+    if tfrecord_cache is not None:
+
+        shard_files = sorted(tf.io.gfile.glob(os.path.join(tfrecord_cache, 'shard-*.tfrecord')))
+        if len(shard_files) == 0:
+            print('Building TFRecord cache of test images in {}'.format(tfrecord_cache))
+            build_tfrecord_cache(data_generator, tfrecord_cache)
+            shard_files = sorted(tf.io.gfile.glob(os.path.join(tfrecord_cache, 'shard-*.tfrecord')))
+        
+        meta_file = os.path.join(tfrecord_cache, 'meta.json')
+        meta = {}
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+        if meta.get('labels_sha1') != test_labels_digest(data_generator):
+            raise ValueError('The TFRecord cache in {} has been built for a different dataset or class list. Delete it to re-build it.'.format(tfrecord_cache))
+        
+        mean, std = data_generator.channel_stats()
+        stats_shape = (1, 1, -1) if K.image_data_format() == 'channels_last' else (-1, 1, 1)
+        mean = tf.constant(np.reshape(mean, stats_shape), dtype = tf.float32)
+        std = tf.constant(np.reshape(std, stats_shape), dtype = tf.float32)
+
+        features = {
+            'img'   : tf.io.FixedLenFeature([], tf.string),
+            'shape' : tf.io.FixedLenFeature([3], tf.int64),
+            'label' : tf.io.FixedLenFeature([], tf.int64)
+        }
+
+        def parse_example(serialized):
+            example = tf.io.parse_single_example(serialized, features)
+            img = tf.reshape(tf.io.decode_raw(example['img'], tf.uint8), example['shape'])
+            img.set_shape(image_shape[1:])
+            return (tf.cast(img, tf.float32) - mean) / std, example['label']
+
+        # Reading one image from each shard in turn restores the original order (see `build_tfrecord_cache`).
+        dataset = tf.data.Dataset.from_tensor_slices(shard_files)
+        dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length = len(shard_files), block_length = 1,
+                                     num_parallel_calls = tf.data.experimental.AUTOTUNE)
+        dataset = dataset.map(parse_example, num_parallel_calls = num_parallel_calls)
+        # Requires fixed-size crops, which are used by all built-in datasets.
+        dataset = dataset.batch(batch_size)
     
-    return (X, embedding[y]) if num_classes is None else (X, [embedding[y], keras.utils.to_categorical(y, num_classes)])
+    else:
+
+        if train:
+            sequence = data_generator.train_sequence(batch_size, shuffle = shuffle)
+        else:
+            sequence = data_generator.test_sequence(batch_size, shuffle = shuffle)
+
+        def batch_indices():
+            # Keras does not call `on_epoch_end` on sequences wrapped in a dataset, so we re-shuffle at the beginning of each pass.
+            # The iterator of the previous pass has been exhausted at this point, so there are no pending requests for batches.
+            sequence.on_epoch_end()
+            for i in range(len(sequence)):
+                yield i
+
+        def cast_batch(X, y):
+            return X.astype(np.float32, copy = False), y.astype(np.int64, copy = False)
+
+        def load_batch(idx):
+            return cast_batch(*sequence[idx])
+
+        def parallel_load_batch(idx):
+            X, y = tf.numpy_function(load_batch, [idx], (tf.float32, tf.int64))
+            X.set_shape(image_shape)
+            y.set_shape((None,))
+            return X, y
+
+        # The enqueuer is started on the first pass and keeps running afterwards. It calls `on_epoch_end` itself after
+        # each epoch, which is why every pass must provide exactly `len(sequence)` batches.
+        enqueuer = keras.utils.OrderedEnqueuer(sequence, use_multiprocessing = True) if processes > 0 else None
+        enqueued_batches = []
+
+        def load_enqueued_batches():
+            if not enqueued_batches:
+                enqueuer.start(workers = processes, max_queue_size = 2 * processes)
+                enqueued_batches.append(enqueuer.get())
+            for _ in range(len(sequence)):
+                yield cast_batch(*next(enqueued_batches[0]))
+
+        if enqueuer is not None:
+            dataset = tf.data.Dataset.from_generator(load_enqueued_batches, output_types = (tf.float32, tf.int64), output_shapes = (image_shape, (None,)))
+        else:
+            dataset = tf.data.Dataset.from_generator(batch_indices, output_types = tf.int64, output_shapes = ())
+            dataset = dataset.map(parallel_load_batch, num_parallel_calls = num_parallel_calls)
+
+    if embedding is not None:
+        target = lambda y: tf.gather(embedding, y)
+    else:
+        target = lambda y: y
+    if num_classes is not None:
+        transform_batch = lambda X, y: (X, (target(y), tf.one_hot(y, num_classes)))
+    else:
+        transform_batch = lambda X, y: (X, target(y))
+
+    if cache:
+        dataset = dataset.cache('{}-{}-bs{}'.format(cache, test_labels_digest(data_generator)[:16], batch_size))
+    elif cache is not None:
+        dataset = dataset.cache()
+    dataset = dataset.map(transform_batch, num_parallel_calls = tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(prefetch)
+    if device is not None:
+        dataset = dataset.apply(tf.data.experimental.prefetch_to_device(device, buffer_size = 2))
+    return dataset
 
 
 
@@ -61,11 +306,21 @@ if __name__ == '__main__':
     arggroup.add_argument('--embedding', type = str, required = True,
                           help = 'Path to a pickle dump of embeddings generated by compute_class_embeddings.py. '
                                  'The special value "onehot" may be used to generate one-hot embeddings on the fly.')
+    arggroup.add_argument('--tfrecord_cache', type = str, default = None,
+                          help = 'Directory where pre-processed test images will be cached as TFRecord files, so that they do not need to be decoded again for each evaluation. '
+                                 'The cache will be built if it does not exist yet and must be deleted manually when the dataset or the class list of the embedding changes.')
+    arggroup.add_argument('--cache_test', type = str, nargs = '?', default = None, const = '',
+                          help = 'Keep pre-processed test batches after the first pass for re-use in subsequent validation and prediction passes. '
+                                 'They will be cached in memory, unless a filename is specified. '
+                                 'The filename will be suffixed by a hash of the test labels and the validation batch size. '
+                                 'An existing cache file with the same suffix will be re-used and must be deleted manually when the test images change.')
     arggroup = parser.add_argument_group('Training parameters')
     arggroup.add_argument('--architecture', type = str, default = 'simple', choices = utils.ARCHITECTURES, help = 'Type of network architecture.')
-    arggroup.add_argument('--loss', type = str, default = 'inv_corr', choices = ['mse', 'inv_corr', 'unnorm_corr', 'softmax_corr'],
+    arggroup.add_argument('--loss', type = str, default = 'inv_corr', choices = ['mse', 'inv_corr', 'unnorm_corr', 'softmax_corr', 'cos_sim'],
                           help = 'Loss function for learning embeddings. Use "mse" (mean squared error) for distance-based and "inv_corr" (negated dot product) for similarity-based L2-normalized embeddings. '
-                                 '"unnorm_corr" and "softmax_corr" are the same as "inv_corr", but the first does not perform L2-normalization and the latter performs softmax activation instead.')
+                                 '"unnorm_corr" and "softmax_corr" are the same as "inv_corr", but the first does not perform L2-normalization and the latter performs softmax activation instead. '
+                                 '"cos_sim" applies softmax cross-entropy to the cosine similarities between the L2-normalized image embeddings and all class embeddings.')
+    arggroup.add_argument('--temperature', type = float, default = 0.1, help = 'Temperature which cosine similarities are divided by for the "cos_sim" loss.')
     arggroup.add_argument('--cls_weight', type = float, default = 0.0, help = 'If set to a positive value, an additional classification layer will be added and this parameter specifies the weight of the softmax loss.')
     arggroup.add_argument('--cls_base', type = str, default = None, help = 'Name or index of the layer that the classification layer should be based on. If not specified, the final embedding layer will be used.')
     arggroup.add_argument('--lr_schedule', type = str, default = 'SGDR', choices = utils.LR_SCHEDULES, help = 'Type of learning rate schedule.')
@@ -75,20 +330,25 @@ if __name__ == '__main__':
     arggroup.add_argument('--epochs', type = int, default = None, help = 'Number of training epochs.')
     arggroup.add_argument('--batch_size', type = int, default = 100, help = 'Batch size.')
     arggroup.add_argument('--val_batch_size', type = int, default = None, help = 'Validation batch size.')
-    arggroup.add_argument('--snapshot', type = str, default = None, help = 'Path where snapshots should be stored after every epoch. If existing, it will be used to resume training.')
+    arggroup.add_argument('--snapshot', type = str, default = None, help = 'Path where snapshots of the model weights should be stored after every epoch. If existing, it will be used to resume training.')
     arggroup.add_argument('--snapshot_best', type = str, nargs = '?', default = None, const = 'val_loss', help = 'Only store best-performing model as checkpoint, identified by monitoring the specified metric.')
     arggroup.add_argument('--initial_epoch', type = int, default = 0, help = 'Initial epoch for resuming training from snapshot.')
     arggroup.add_argument('--finetune', type = str, default = None, help = 'Path to pre-trained weights to be fine-tuned (will be loaded by layer name).')
     arggroup.add_argument('--finetune_init', type = int, default = 8, help = 'Number of initial epochs for training just the new layers before fine-tuning.')
     arggroup.add_argument('--gpus', type = int, default = 1, help = 'Number of GPUs to be used.')
-    arggroup.add_argument('--read_workers', type = int, default = 8, help = 'Number of parallel data pre-processing processes.')
-    arggroup.add_argument('--queue_size', type = int, default = 100, help = 'Maximum size of data queue.')
-    arggroup.add_argument('--gpu_merge', action = 'store_true', default = False, help = 'Merge weights on the GPU.')
+    arggroup.add_argument('--xla', action = 'store_true', default = False, help = 'Compile the entire training step with XLA, fusing operations into combined kernels.')
+    arggroup.add_argument('--mixed_precision', action = 'store_true', default = False, help = 'Train with float16 computations and float32 variables (requires a GPU with tensor cores for being beneficial).')
+    arggroup.add_argument('--read_workers', type = int, default = None, help = 'Number of parallel data pre-processing threads. Tuned automatically if not specified.')
+    arggroup.add_argument('--read_processes', type = int, default = 0,
+                          help = 'If greater than 0, the number of data pre-processing processes to be used instead of threads, which avoids contention for the GIL when pre-processing is expensive.')
+    arggroup.add_argument('--queue_size', type = int, default = None, help = 'Number of batches to be prefetched. Tuned automatically if not specified.')
     arggroup = parser.add_argument_group('Output parameters')
     arggroup.add_argument('--model_dump', type = str, default = None, help = 'Filename where the learned model definition and weights should be written to.')
     arggroup.add_argument('--weight_dump', type = str, default = None, help = 'Filename where the learned model weights should be written to (without model definition).')
-    arggroup.add_argument('--feature_dump', type = str, default = None, help = 'Filename where learned embeddings for test images should be written to.')
+    arggroup.add_argument('--feature_dump', type = str, default = None, help = 'Filename where learned embeddings for test images should be written to (as HDF5 file with datasets "feat" and "index").')
     arggroup.add_argument('--log_dir', type = str, default = None, help = 'Tensorboard log directory.')
+    arggroup.add_argument('--profile_batches', type = int, nargs = 2, default = None, metavar = ('START', 'STOP'),
+                          help = 'Optionally, the range of training batches to be profiled and written to the Tensorboard log directory.')
     arggroup.add_argument('--no_progress', action = 'store_true', default = False, help = 'Do not display training progress, but just the final performance.')
     arggroup.add_argument('--top_k_acc', type = int, nargs = '+', default = [], help = 'If given, top k accuracy will be reported in addition to top 1 accuracy.')
     utils.add_lr_schedule_arguments(parser)
@@ -97,9 +357,16 @@ if __name__ == '__main__':
     
     if args.val_batch_size is None:
         args.val_batch_size = args.batch_size
+    if args.read_workers is None:
+        args.read_workers = tf.data.experimental.AUTOTUNE
+    if args.queue_size is None:
+        args.queue_size = tf.data.experimental.AUTOTUNE
 
     # Configure environment
-    K.set_session(K.tf.Session(config = K.tf.ConfigProto(gpu_options = { 'allow_growth' : True })))
+    for gpu in tf.config.experimental.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+    if args.mixed_precision:
+        keras.mixed_precision.set_global_policy('mixed_float16')
 
     # Load class embeddings
     if args.embedding == 'onehot':
@@ -109,75 +376,111 @@ if __name__ == '__main__':
         with open(args.embedding, 'rb') as pf:
             embedding = pickle.load(pf)
             embed_labels = embedding['ind2label']
-            embedding = embedding['embedding']
+            embedding = np.ascontiguousarray(embedding['embedding'], dtype = np.float32)
 
     # Load dataset
     data_generator = get_data_generator(args.dataset, args.data_root, classes = embed_labels)
     if embedding is None:
-        embedding = np.eye(data_generator.num_classes)
+        embedding = np.eye(data_generator.num_classes, dtype = np.float32)
+    
+    # Keep a single copy of the embeddings on the host for the target look-up in all input pipelines.
+    # A variable is referenced by the pipelines instead of being copied into the graph of each of them.
+    with tf.device('/cpu:0'):
+        embedding_tf = tf.Variable(embedding, trainable = False, name = 'class_embeddings')
 
     # Construct and train model
-    if (args.gpus <= 1) or args.gpu_merge:
+    if args.gpus <= 1:
+        strategy = tf.distribute.get_strategy()
+    else:
+        strategy = tf.distribute.MirroredStrategy(['/gpu:{}'.format(i) for i in range(args.gpus)])
+    with strategy.scope():
+        embed_model = utils.build_network(embedding.shape[1], args.architecture, input_channels=data_generator.num_channels)
+        model = embed_model
+        if args.loss == 'inv_corr':
+            # The sum of squares could overflow in float16, so the normalization is always performed in float32.
+            model = keras.models.Model(model.inputs, utils.L2Norm(dtype = 'float32', name = 'l2norm')(model.output))
+        elif args.loss == 'softmax_corr':
+            model = keras.models.Model(model.inputs, keras.layers.Activation('softmax', dtype = 'float32', name = 'softmax')(model.output))
+        elif args.loss == 'cos_sim':
+            model = keras.models.Model(model.inputs, utils.CosSimHead(len(embedding), args.temperature, dtype = 'float32', name = 'cossim')(model.output))
+            # Normalize the class embeddings, so that the logits are actual cosine similarities
+            model.get_layer('cossim').set_weights([embedding / np.linalg.norm(embedding, axis = -1, keepdims = True)])
+        elif args.mixed_precision:
+            # Losses and nearest-neighbour metrics should be computed on the float32 embedding
+            model = keras.models.Model(model.inputs, keras.layers.Activation('linear', dtype = 'float32', name = 'embedding_float32')(model.output))
+        if args.cls_weight > 0:
+            model = cls_model(model, data_generator.num_classes, args.cls_base)
         if args.snapshot and os.path.exists(args.snapshot):
             print('Resuming from snapshot {}'.format(args.snapshot))
-            model = keras.models.load_model(args.snapshot, custom_objects = utils.get_custom_objects(args.architecture), compile = False)
-        else:
-            embed_model = utils.build_network(embedding.shape[1], args.architecture, input_channels=data_generator.num_channels)
-            model = embed_model
-            if args.loss == 'inv_corr':
-                model = keras.models.Model(model.inputs, keras.layers.Lambda(utils.l2norm, name = 'l2norm')(model.output))
-            elif args.loss == 'softmax_corr':
-                model = keras.models.Model(model.inputs, keras.layers.Activation('softmax', name = 'softmax')(model.output))
-            if args.cls_weight > 0:
-                model = cls_model(model, data_generator.num_classes, args.cls_base)
-        par_model = model if args.gpus <= 1 else keras.utils.multi_gpu_model(model, gpus = args.gpus, cpu_merge = False)
-    else:
-        with K.tf.device('/cpu:0'):
-            if args.snapshot and os.path.exists(args.snapshot):
-                print('Resuming from snapshot {}'.format(args.snapshot))
-                model = keras.models.load_model(args.snapshot, custom_objects = utils.get_custom_objects(args.architecture), compile = False)
-            else:
-                embed_model = utils.build_network(embedding.shape[1], args.architecture, input_channels=data_generator.num_channels)
-                model = embed_model
-                if args.loss == 'inv_corr':
-                    model = keras.models.Model(model.inputs, keras.layers.Lambda(utils.l2norm, name = 'l2norm')(model.output))
-                elif args.loss == 'softmax_corr':
-                    model = keras.models.Model(model.inputs, keras.layers.Activation('softmax', name = 'softmax')(model.output))
-                if args.cls_weight > 0:
-                    model = cls_model(model, data_generator.num_classes, args.cls_base)
-        par_model = keras.utils.multi_gpu_model(model, gpus = args.gpus)
+            model.load_weights(args.snapshot)
     
     if args.loss == 'inv_corr':
         embedding_layer_name = 'l2norm'
     elif args.loss == 'softmax_corr':
         embedding_layer_name = 'softmax'
+    elif args.loss == 'cos_sim':
+        embedding_layer_name = 'cossim'
+    elif args.mixed_precision:
+        embedding_layer_name = 'embedding_float32'
     else:
         embedding_layer_name = 'embedding'
     
     if not args.no_progress:
         model.summary()
     
-    batch_transform_kwargs = {
-        'embedding' : embedding,
-        'num_classes' : data_generator.num_classes if args.cls_weight > 0 else None
+    dataset_kwargs = {
+        'embedding' : embedding_tf if args.loss != 'cos_sim' else None,
+        'num_classes' : data_generator.num_classes if args.cls_weight > 0 else None,
+        'num_parallel_calls' : args.read_workers,
+        'processes' : args.read_processes,
+        'prefetch' : args.queue_size,
+        'device' : '/gpu:0' if (args.gpus == 1) and (len(tf.config.experimental.list_physical_devices('GPU')) > 0) else None
     }
-    if args.loss.endswith('_corr'):
+    train_data = build_tf_dataset(data_generator, args.batch_size, train = True, **dataset_kwargs)
+    test_data = build_tf_dataset(data_generator, args.val_batch_size, train = False, tfrecord_cache = args.tfrecord_cache, cache = args.cache_test, **dataset_kwargs)
+
+    if args.loss == 'cos_sim':
+        loss = keras.losses.SparseCategoricalCrossentropy(from_logits = True)
+    elif args.loss.endswith('_corr'):
         loss = utils.inv_correlation
-        metrics = ['accuracy' if (args.loss == 'softmax_corr') or (args.embedding == 'onehot') else utils.nn_accuracy(embedding, dot_prod_sim = True)]
-        if len(args.top_k_acc) > 0:
-            for k in args.top_k_acc:
-                metrics.append(utils.top_k_acc(k) if (args.loss == 'softmax_corr') or (args.embedding == 'onehot') else utils.nn_accuracy(embedding, dot_prod_sim = True, k = k))
     else:
         loss = utils.squared_distance
-        metrics = ['accuracy' if args.embedding == 'onehot' else utils.nn_accuracy(embedding, dot_prod_sim = False)]
+    
+    def build_metrics():
+        # Keras prefixes the names of metric objects with the name of the output when compiling a model,
+        # so new objects are created for each call to compile(). This must happen in the scope of the
+        # distribution strategy.
+        if args.loss == 'cos_sim':
+            metrics = ['accuracy']
+            if len(args.top_k_acc) > 0:
+                for k in args.top_k_acc:
+                    metrics.append(utils.top_k_acc(k, sparse = True))
+        elif args.loss.endswith('_corr'):
+            metrics = ['accuracy' if (args.loss == 'softmax_corr') or (args.embedding == 'onehot') else streaming_metrics.NNAccuracy(embedding_tf, dot_prod_sim = True)]
+            if len(args.top_k_acc) > 0:
+                for k in args.top_k_acc:
+                    metrics.append(utils.top_k_acc(k) if (args.loss == 'softmax_corr') or (args.embedding == 'onehot') else streaming_metrics.NNAccuracy(embedding_tf, dot_prod_sim = True, k = k))
+        else:
+            metrics = ['accuracy' if args.embedding == 'onehot' else streaming_metrics.NNAccuracy(embedding_tf, dot_prod_sim = False)]
+            if len(args.top_k_acc) > 0:
+                for k in args.top_k_acc:
+                    metrics.append(utils.top_k_acc(k) if args.embedding == 'onehot' else streaming_metrics.NNAccuracy(embedding_tf, dot_prod_sim = False, k = k))
+    
+        cls_metrics = ['accuracy']
         if len(args.top_k_acc) > 0:
             for k in args.top_k_acc:
-                metrics.append(utils.top_k_acc(k) if args.embedding == 'onehot' else utils.nn_accuracy(embedding, dot_prod_sim = False, k = k))
+                cls_metrics.append(utils.top_k_acc(k))
     
-    cls_metrics = ['accuracy']
-    if len(args.top_k_acc) > 0:
-        for k in args.top_k_acc:
-            cls_metrics.append(utils.top_k_acc(k))
+        # Balanced accuracy is accumulated during evaluation instead of predicting all test images separately
+        balanced_acc = None
+        if args.cls_weight > 0:
+            balanced_acc = streaming_metrics.BalancedAccuracy(data_generator.num_classes)
+            cls_metrics.append(balanced_acc)
+        elif (args.embedding == 'onehot') or (args.loss == 'cos_sim'):
+            balanced_acc = streaming_metrics.BalancedAccuracy(data_generator.num_classes)
+            metrics.append(balanced_acc)
+        
+        return metrics, cls_metrics, balanced_acc
     
     # Load pre-trained weights and train last layer for a few epochs
     if args.finetune:
@@ -188,20 +491,24 @@ if __name__ == '__main__':
             for layer in model.layers:
                 layer.trainable = (layer.name in ('embedding', 'prob'))
             embed_model.layers[-1].trainable = True
-            if args.cls_weight > 0:
-                par_model.compile(optimizer = keras.optimizers.SGD(lr=args.sgd_lr, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad),
-                                loss = { embedding_layer_name : loss, 'prob' : 'categorical_crossentropy' },
-                                loss_weights = { embedding_layer_name : 1.0, 'prob' : args.cls_weight },
-                                metrics = { embedding_layer_name : metrics, 'prob' : cls_metrics })
-            else:
-                par_model.compile(optimizer = keras.optimizers.SGD(lr=args.sgd_lr, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad),
-                                loss = loss,
-                                metrics = metrics)
-            par_model.fit_generator(
-                    data_generator.train_sequence(args.batch_size, batch_transform = transform_inputs, batch_transform_kwargs = batch_transform_kwargs),
-                    validation_data = data_generator.test_sequence(args.val_batch_size, batch_transform = transform_inputs, batch_transform_kwargs = batch_transform_kwargs),
-                    epochs = args.finetune_init, verbose = not args.no_progress,
-                    max_queue_size = args.queue_size, workers = args.read_workers, use_multiprocessing = True)
+            with strategy.scope():
+                optimizer = SGD(learning_rate=args.sgd_lr, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad)
+                if args.mixed_precision:
+                    optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+                metrics, cls_metrics, balanced_acc = build_metrics()
+                if args.cls_weight > 0:
+                    model.compile(optimizer = optimizer,
+                                  loss = { embedding_layer_name : loss, 'prob' : 'categorical_crossentropy' },
+                                  loss_weights = { embedding_layer_name : 1.0, 'prob' : args.cls_weight },
+                                  metrics = { embedding_layer_name : metrics, 'prob' : cls_metrics },
+                                  jit_compile = args.xla)
+                else:
+                    model.compile(optimizer = optimizer,
+                                  loss = loss,
+                                  metrics = metrics,
+                                  jit_compile = args.xla)
+            model.fit(train_data, validation_data = test_data,
+                      epochs = args.finetune_init, verbose = not args.no_progress)
             for layer in model.layers:
                 layer.trainable = True
             print('Full model training')
@@ -211,48 +518,52 @@ if __name__ == '__main__':
 
     if args.log_dir:
         if os.path.isdir(args.log_dir):
-            shutil.rmtree(args.log_dir, ignore_errors = True)
-        callbacks.append(keras.callbacks.TensorBoard(log_dir = args.log_dir, write_graph = False))
+            # Move old logs out of the way and delete them in the background, which may take a while on network file systems
+            old_log_dir = '{}.old-{}'.format(os.path.normpath(args.log_dir), os.getpid())
+            try:
+                os.rename(args.log_dir, old_log_dir)
+                threading.Thread(target = shutil.rmtree, args = (old_log_dir,), kwargs = { 'ignore_errors' : True }).start()
+            except OSError:
+                shutil.rmtree(args.log_dir, ignore_errors = True)
+        callbacks.append(keras.callbacks.TensorBoard(log_dir = args.log_dir, write_graph = False, profile_batch = tuple(args.profile_batches) if args.profile_batches else 0))
     
     if args.snapshot:
         snapshot_kwargs = {}
         if args.snapshot_best:
             snapshot_kwargs['save_best_only'] = True
             snapshot_kwargs['monitor'] = args.snapshot_best
-        callbacks.append(keras.callbacks.ModelCheckpoint(args.snapshot, **snapshot_kwargs) if args.gpus <= 1 else utils.TemplateModelCheckpoint(model, args.snapshot, **snapshot_kwargs))
+        callbacks.append(utils.AsyncModelCheckpoint(model, args.snapshot, **snapshot_kwargs))
 
     if args.max_decay > 0:
         decay = (1.0/args.max_decay - 1) / ((data_generator.num_train // args.batch_size) * (args.epochs if args.epochs else num_epochs))
     else:
         decay = 0.0
-    if args.cls_weight > 0:
-        par_model.compile(optimizer = keras.optimizers.SGD(lr=args.sgd_lr, decay=decay, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad),
+    with strategy.scope():
+        optimizer = SGD(learning_rate=args.sgd_lr, decay=decay, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad)
+        if args.mixed_precision:
+            optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+        metrics, cls_metrics, balanced_acc = build_metrics()
+        if args.cls_weight > 0:
+            model.compile(optimizer = optimizer,
                           loss = { embedding_layer_name : loss, 'prob' : 'categorical_crossentropy' },
                           loss_weights = { embedding_layer_name : 1.0, 'prob' : args.cls_weight },
-                          metrics = { embedding_layer_name : metrics, 'prob' : cls_metrics })
-    else:
-        par_model.compile(optimizer = keras.optimizers.SGD(lr=args.sgd_lr, decay=decay, momentum=0.9, nesterov=args.nesterov, clipnorm = args.clipgrad),
+                          metrics = { embedding_layer_name : metrics, 'prob' : cls_metrics },
+                          jit_compile = args.xla)
+        else:
+            model.compile(optimizer = optimizer,
                           loss = loss,
-                          metrics = metrics)
+                          metrics = metrics,
+                          jit_compile = args.xla)
 
-    par_model.fit_generator(
-              data_generator.train_sequence(args.batch_size, batch_transform = transform_inputs, batch_transform_kwargs = batch_transform_kwargs),
-              validation_data = data_generator.test_sequence(args.val_batch_size, batch_transform = transform_inputs, batch_transform_kwargs = batch_transform_kwargs),
+    model.fit(train_data, validation_data = test_data,
               epochs = args.epochs if args.epochs else num_epochs, initial_epoch = args.initial_epoch,
-              callbacks = callbacks, verbose = not args.no_progress,
-              max_queue_size = args.queue_size, workers = args.read_workers, use_multiprocessing = True)
+              callbacks = callbacks, verbose = not args.no_progress)
 
     # Evaluate final performance
-    print(par_model.evaluate_generator(data_generator.test_sequence(args.val_batch_size, batch_transform = transform_inputs, batch_transform_kwargs = batch_transform_kwargs)))
-    if (args.cls_weight > 0) or (args.embedding == 'onehot'):
-        test_pred = par_model.predict_generator(data_generator.test_sequence(args.val_batch_size, batch_transform = transform_inputs, batch_transform_kwargs = batch_transform_kwargs))
-        if args.cls_weight > 0:
-            test_pred = test_pred[1]
-        test_pred = test_pred.argmax(axis=-1)
-        class_freq = np.bincount(data_generator.labels_test)
-        print('Average Accuracy: {:.4f}'.format(
-            ((test_pred == np.asarray(data_generator.labels_test)).astype(np.float) / class_freq[np.asarray(data_generator.labels_test)]).sum() / len(class_freq)
-        ))
+    test_perf = model.evaluate(test_data, verbose = not args.no_progress)
+    print(test_perf)
+    if balanced_acc is not None:
+        print('Average Accuracy: {:.4f}'.format(float(balanced_acc.result())))
 
     # Save model
     if args.weight_dump:
@@ -268,8 +579,16 @@ if __name__ == '__main__':
 
     # Save test image embeddings
     if args.feature_dump:
-        pred_features = par_model.predict_generator(data_generator.flow_test(1, False), data_generator.num_test)
-        if args.cls_weight > 0:
-            pred_features = pred_features[0]
-        with open(args.feature_dump,'wb') as dump_file:
-            pickle.dump({ 'feat' : dict(enumerate(pred_features)) }, dump_file)
+        if args.loss == 'cos_sim':
+            # Dump the L2-normalized image embeddings instead of their similarities to the classes
+            with strategy.scope():
+                feat_model = keras.models.Model(model.inputs, model.get_layer('cossim').input)
+            pred_features = feat_model.predict(test_data, verbose = not args.no_progress).astype(np.float32, copy = False)
+            pred_features /= np.linalg.norm(pred_features, axis = -1, keepdims = True)
+        else:
+            pred_features = model.predict(test_data, verbose = not args.no_progress)
+            if args.cls_weight > 0:
+                pred_features = pred_features[0]
+        with h5py.File(args.feature_dump, 'w') as dump_file:
+            dump_file.create_dataset('feat', data = pred_features.astype(np.float16), compression = 'lzf')
+            dump_file.create_dataset('index', data = np.arange(len(pred_features)))
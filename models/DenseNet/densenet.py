@@ -10,21 +10,31 @@ from __future__ import division
 import warnings
 
 from keras.models import Model
-from keras.layers.core import Dense, Dropout, Activation, Reshape
-from keras.layers.convolutional import Conv2D, Conv2DTranspose, UpSampling2D
-from keras.layers.pooling import AveragePooling2D, MaxPooling2D
-from keras.layers.pooling import GlobalAveragePooling2D
+from keras.layers import Dense, Dropout, Activation, Reshape
+from keras.layers import Conv2D, Conv2DTranspose, UpSampling2D
+from keras.layers import AveragePooling2D, MaxPooling2D
+from keras.layers import GlobalAveragePooling2D
 from keras.layers import Input
-from keras.layers.merge import concatenate
-from keras.layers.normalization import BatchNormalization
+from keras.layers import concatenate
+from keras.layers import BatchNormalization
 from keras.regularizers import l2
-from keras.utils.layer_utils import convert_all_kernels_in_model, convert_dense_weights_data_format
+try:
+    from keras.utils.layer_utils import convert_all_kernels_in_model, convert_dense_weights_data_format
+except ImportError:
+    # Only required for the Theano backend, which is not supported by recent versions of Keras anymore
+    convert_all_kernels_in_model = convert_dense_weights_data_format = None
 from keras.utils.data_utils import get_file
-from keras.engine.topology import get_source_inputs
+try:
+    from keras.utils import get_source_inputs
+except ImportError:
+    from keras.engine.topology import get_source_inputs
 try:
     from keras.applications.imagenet_utils import _obtain_input_shape, decode_predictions
 except ImportError:
-    from keras_applications.imagenet_utils import _obtain_input_shape, decode_predictions
+    try:
+        from keras.applications.imagenet_utils import obtain_input_shape as _obtain_input_shape, decode_predictions
+    except ImportError:
+        from keras_applications.imagenet_utils import _obtain_input_shape, decode_predictions
 import keras.backend as K
 
 from subpixel import SubPixelUpscaling
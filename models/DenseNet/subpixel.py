@@ -1,8 +1,14 @@
 from __future__ import absolute_import
 
 from keras import backend as K
-from keras.engine import Layer
-from keras.utils.generic_utils import get_custom_objects
+try:
+    from keras.layers import Layer
+except ImportError:
+    from keras.engine import Layer
+try:
+    from keras.utils import get_custom_objects
+except ImportError:
+    from keras.utils.generic_utils import get_custom_objects
 try:
     from keras.utils.conv_utils import normalize_data_format
 except ImportError:
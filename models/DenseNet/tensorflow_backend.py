@@ -1,7 +1,6 @@
 import tensorflow as tf
 
-from keras.backend import tensorflow_backend as KTF
-from keras.backend.common import image_data_format
+from keras.backend import image_data_format
 
 py_all = all
 
@@ -15,6 +14,7 @@ def depth_to_space(input, scale, data_format=None):
     else:
         data_format = 'NHWC'
 
-    data_format = data_format.lower()
-    out = tf.depth_to_space(input, scale, data_format=data_format)
+    # Older versions of TensorFlow 1.x (e.g., 1.8) only provide tf.depth_to_space
+    _depth_to_space = getattr(tf.nn, 'depth_to_space', None) or tf.depth_to_space
+    out = _depth_to_space(input, scale, data_format=data_format)
     return out
@@ -19,8 +19,14 @@ from keras import backend as K
 from keras.layers import Input
 from keras.layers import Dense, Activation, Flatten, Conv2D, AveragePooling2D, GlobalAveragePooling2D, BatchNormalization
 from keras.models import Model
-from keras.engine import Layer, InputSpec
-from keras.engine.topology import get_source_inputs
+try:
+    from keras.layers import Layer, InputSpec
+except ImportError:
+    from keras.engine import Layer, InputSpec
+try:
+    from keras.utils import get_source_inputs
+except ImportError:
+    from keras.engine.topology import get_source_inputs
 from keras.utils import layer_utils, conv_utils
 from keras.utils.data_utils import get_file
 
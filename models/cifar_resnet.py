@@ -11,12 +11,19 @@ from __future__ import absolute_import
 import warnings
 
 from keras import layers, regularizers
+import tensorflow as tf
 from keras import backend as K
 from keras.layers import Input
 from keras.layers import Dense, Activation, Flatten, Conv2D, AveragePooling2D, GlobalAveragePooling2D, GlobalMaxPooling2D, BatchNormalization
 from keras.models import Model
-from keras.engine import Layer, InputSpec
-from keras.engine.topology import get_source_inputs
+try:
+    from keras.layers import Layer, InputSpec
+except ImportError:
+    from keras.engine import Layer, InputSpec
+try:
+    from keras.utils import get_source_inputs
+except ImportError:
+    from keras.engine.topology import get_source_inputs
 from keras.utils import layer_utils, conv_utils
 from keras.utils.data_utils import get_file
 try:
@@ -58,7 +65,7 @@ class ChannelPadding(Layer):
         pattern = [[0,0] for i in range(len(inputs.shape))]
         axis = 1 if self.data_format == 'channels_first' else -1
         pattern[axis] = self.padding
-        return K.tf.pad(inputs, pattern)
+        return tf.pad(inputs, pattern)
 
     def get_config(self):
         config = {'padding': self.padding, 'data_format': self.data_format}
@@ -1,7 +1,6 @@
 from keras.models import Model
 from keras.layers import Input, Add, Activation, Dropout, GlobalAveragePooling2D, Dense
-from keras.layers.convolutional import Convolution2D
-from keras.layers.normalization import BatchNormalization
+from keras.layers import Convolution2D, BatchNormalization
 from keras import backend as K
 
 
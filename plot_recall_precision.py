@@ -24,7 +24,7 @@ if __name__ == '__main__':
     arggroup.add_argument('--data_root', type = str, required = True, help = 'Root directory of the dataset.')
     arggroup.add_argument('--classes_from', type = str, default = None, help = 'Optionally, a path to a pickle dump containing a dictionary with item "ind2label" specifying the classes to be considered.')
     arggroup = parser.add_argument_group('Features')
-    arggroup.add_argument('--feat', type = str, action = 'append', required = True, help = 'Pickle file containing a dictionary mapping image IDs to features.')
+    arggroup.add_argument('--feat', type = str, action = 'append', required = True, help = 'HDF5 file with a feature matrix or pickle file containing a dictionary mapping image IDs to features.')
     arggroup.add_argument('--label', type = str, action = 'append', help = 'Label for the corresponding features.')
     arggroup.add_argument('--norm', type = str2bool, action = 'append', help = 'Whether to L2-normalize the corresponding features or not (defaults to False).')
     arggroup = parser.add_argument_group('Plot')
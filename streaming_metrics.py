@@ -0,0 +1,121 @@
+""" Stateful Keras metrics used by `learn_image_embeddings.py`.
+
+These are based on the metric classes of TensorFlow 2 Keras and are hence kept apart from `utils`,
+which is shared with scripts that still require older versions of Keras.
+"""
+
+import tensorflow as tf
+import keras
+
+
+class NNAccuracy(keras.metrics.Mean):
+    """ Streaming metric computing classification accuracy by assigning samples to the class with the nearest embedding in feature space.
+
+    In contrast to `utils.nn_accuracy`, the index of the predicted class is compared with the index of the true class,
+    so that the result does not depend on a numerical tolerance, which is important when training with float16.
+    The similarities or distances of a batch to all class embeddings are obtained from a single matrix multiplication.
+    """
+
+    def __init__(self, embedding, dot_prod_sim = False, k = 1, name = None, **kwargs):
+        """
+        # Arguments:
+
+        - embedding: 2-d float32 variable whose rows are class embeddings. It is only read, so that the same variable
+                     can be shared among several metrics instead of each of them holding a copy of the embeddings.
+                     Numpy arrays are accepted as well.
+
+        - dot_prod_sim: If True, the dot product will be used to find the most similar embedding (assumes L2-normalized embeddings and features).
+                        Otherwise, Euclidean distance will be used.
+        
+        - k: Compute top-k accuracy.
+
+        - name: The name of the metric. Defaults to "max_sim_acc" or "nn_accuracy", depending on `dot_prod_sim`, followed by `k` if it is greater than 1.
+        """
+
+        if name is None:
+            name = 'max_sim_acc' if dot_prod_sim else 'nn_accuracy'
+            if k > 1:
+                name += str(k)
+        super(NNAccuracy, self).__init__(name = name, **kwargs)
+        self.dot_prod_sim = dot_prod_sim
+        self.k = k
+        if not isinstance(embedding, tf.Variable):
+            embedding = tf.constant(embedding, dtype = tf.float32)
+        # Keras would track a variable assigned to an attribute as state of the metric and reset it to zero,
+        # so it is only referenced by a function.
+        self._get_embedding = lambda: embedding
+
+
+    def _neg_distance(self, sim, embedding):
+        """ Turns dot products `sim` between samples `x` and all class embeddings into negated squared Euclidean distances, omitting the constant term `||x||^2`. """
+
+        return 2 * sim - tf.reduce_sum(tf.square(embedding), axis = -1)[None,:]
+
+
+    def update_state(self, y_true, y_pred, sample_weight = None):
+
+        embedding = tf.convert_to_tensor(self._get_embedding())
+
+        # The true class is the one whose embedding has the smallest distance to the target
+        y_true = tf.cast(y_true, tf.float32)
+        true_class = tf.argmax(self._neg_distance(tf.matmul(y_true, embedding, transpose_b = True), embedding), axis = -1, output_type = tf.int32)
+
+        y_pred = tf.cast(y_pred, tf.float32)
+        scores = tf.matmul(y_pred, embedding, transpose_b = True)
+        if not self.dot_prod_sim:
+            scores = self._neg_distance(scores, embedding)
+        
+        if self.k <= 1:
+            correct = tf.equal(tf.argmax(scores, axis = -1, output_type = tf.int32), true_class)
+        else:
+            correct = tf.math.in_top_k(true_class, scores, self.k)
+        return super(NNAccuracy, self).update_state(tf.cast(correct, self.dtype), sample_weight = sample_weight)
+
+
+class BalancedAccuracy(keras.metrics.Metric):
+    """ Streaming metric computing the accuracy averaged over all classes (also known as balanced accuracy).
+
+    Instead of collecting all predictions, the numbers of correctly classified and of all samples are accumulated per class.
+    Classes without any samples are ignored when averaging.
+
+    Ground-truth labels may either be given as class indices or one-hot encoded.
+    """
+
+    def __init__(self, num_classes, name = 'balanced_acc', **kwargs):
+
+        super(BalancedAccuracy, self).__init__(name = name, **kwargs)
+        self.num_classes = num_classes
+        self.correct = self.add_weight('correct', shape = (num_classes,), initializer = 'zeros')
+        self.total = self.add_weight('total', shape = (num_classes,), initializer = 'zeros')
+
+
+    def update_state(self, y_true, y_pred, sample_weight = None):
+
+        if (y_true.shape.rank == y_pred.shape.rank) and (y_true.shape[-1] == y_pred.shape[-1]) and (y_pred.shape[-1] != 1):
+            y_true = tf.argmax(y_true, axis = -1, output_type = tf.int32)
+        y_true = tf.reshape(tf.cast(y_true, tf.int32), [-1])
+        y_pred = tf.reshape(tf.argmax(y_pred, axis = -1, output_type = tf.int32), [-1])
+        correct = tf.cast(tf.equal(y_true, y_pred), self.dtype)
+        self.correct.assign_add(tf.math.unsorted_segment_sum(correct, y_true, self.num_classes))
+        self.total.assign_add(tf.math.unsorted_segment_sum(tf.ones_like(correct), y_true, self.num_classes))
+
+
+    def reset_state(self):
+
+        # The default implementation assigns scalar zeros, which does not work for per-class state.
+        for v in self.variables:
+            v.assign(tf.zeros_like(v))
+
+
+    def result(self):
+
+        # Avoid boolean masks, whose dynamic shapes cannot be compiled with XLA
+        num_present = tf.maximum(tf.math.count_nonzero(self.total, dtype = self.dtype), 1)
+        return tf.reduce_sum(tf.math.divide_no_nan(self.correct, self.total)) / num_present
+
+
+    def get_config(self):
+
+        config = { 'num_classes' : self.num_classes }
+        base_config = super(BalancedAccuracy, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -1,8 +1,11 @@
 import sys, os.path
+import concurrent.futures
+import tempfile
 sys.path.append(os.path.join(os.path.dirname(__file__), 'models', 'DenseNet'))
 
 import numpy as np
 
+import tensorflow as tf
 import keras
 from keras import backend as K
 try:
@@ -46,10 +49,16 @@ def inv_correlation(y_true, y_pred):
     return 1. - K.sum(y_true * y_pred, axis = -1)
 
 
-def top_k_acc(k):
-    """ Returns a Keras metric function for measuring top-k accuracy. """
+def top_k_acc(k, sparse = False):
+    """ Returns a Keras metric function for measuring top-k accuracy.
 
-    acc = lambda y_true, y_pred: keras.metrics.top_k_categorical_accuracy(y_true, y_pred, k=k)
+    If `sparse` is True, the ground-truth is expected to be given as class indices instead of one-hot vectors.
+    """
+
+    if sparse:
+        acc = lambda y_true, y_pred: keras.metrics.sparse_top_k_categorical_accuracy(y_true, y_pred, k=k)
+    else:
+        acc = lambda y_true, y_pred: keras.metrics.top_k_categorical_accuracy(y_true, y_pred, k=k)
     acc.name = 'acc{}'.format(k)
     return acc
 
@@ -82,7 +91,7 @@ def nn_accuracy(embedding, dot_prod_sim = False, k = 1):
         if k <= 1:
             return K.cast(K.less(K.abs(true_dist - K.min(dist, axis = -1)), 1e-6), K.floatx())
         else:
-            return K.cast(K.any(K.less(K.abs(-1 * K.tf.nn.top_k(-1 * dist, k, sorted=False)[0] - true_dist[:,None]), 1e-6), axis=-1), K.floatx())
+            return K.cast(K.any(K.less(K.abs(-1 * tf.nn.top_k(-1 * dist, k, sorted=False)[0] - true_dist[:,None]), 1e-6), axis=-1), K.floatx())
     
     def max_sim_acc(y_true, y_pred):
 
@@ -92,7 +101,7 @@ def nn_accuracy(embedding, dot_prod_sim = False, k = 1):
         if k <= 1:
             return K.cast(K.less(K.abs(K.max(sim, axis = -1) - true_sim), 1e-6), K.floatx())
         else:
-            return K.cast(K.any(K.less(K.abs(K.tf.nn.top_k(sim, k, sorted=False)[0] - true_sim[:,None]), 1e-6), axis=-1), K.floatx())
+            return K.cast(K.any(K.less(K.abs(tf.nn.top_k(sim, k, sorted=False)[0] - true_sim[:,None]), 1e-6), axis=-1), K.floatx())
     
     metric = max_sim_acc if dot_prod_sim else nn_accuracy
     if k > 1:
@@ -124,7 +133,60 @@ def devise_ranking_loss(embedding, margin = 0.1):
 
 def l2norm(x):
     """ L2-normalizes a tensor along the last axis. """
-    return K.tf.nn.l2_normalize(x, -1)
+    return tf.nn.l2_normalize(x, -1)
+
+
+class L2Norm(keras.layers.Layer):
+    """ Layer L2-normalizing its input along the last axis.
+
+    In contrast to a `Lambda` layer wrapping `l2norm`, this layer can be serialized without Python bytecode
+    and does not prevent XLA from clustering it together with adjacent operations.
+    """
+
+    def call(self, inputs):
+        return tf.math.l2_normalize(inputs, axis = -1)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+
+class CosSimHead(keras.layers.Layer):
+    """ Layer computing the cosine similarities between its input and a fixed set of class embeddings.
+
+    The input is L2-normalized and multiplied with the transposed matrix of class embeddings, which are hence expected
+    to be L2-normalized as well. The similarities are divided by `temperature`, so that they can be used as logits for
+    a softmax cross-entropy loss on class indices.
+
+    The class embeddings are held in a non-trainable weight, which has to be initialized using `set_weights()`.
+    """
+
+    def __init__(self, num_classes, temperature = 0.1, **kwargs):
+
+        super(CosSimHead, self).__init__(**kwargs)
+        self.num_classes = num_classes
+        self.temperature = temperature
+
+
+    def build(self, input_shape):
+
+        self.embedding = self.add_weight('class_embeddings', shape = (self.num_classes, int(input_shape[-1])), initializer = 'zeros', trainable = False)
+        super(CosSimHead, self).build(input_shape)
+
+
+    def call(self, inputs):
+
+        return tf.matmul(tf.math.l2_normalize(inputs, axis = -1), self.embedding, transpose_b = True) / self.temperature
+
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (self.num_classes,)
+
+
+    def get_config(self):
+
+        config = { 'num_classes' : self.num_classes, 'temperature' : self.temperature }
+        base_config = super(CosSimHead, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
 
 
 def build_network(num_outputs, architecture, classification = False, no_softmax = False, input_channels = None, name = None):
@@ -279,10 +341,10 @@ def build_network(num_outputs, architecture, classification = False, no_softmax
 def get_custom_objects(architecture):
     """ Provides a dictionary with custom objects required for loading a certain model architecture using `keras.models.load_model`. """
     
+    custom_objects = { 'L2Norm' : L2Norm, 'CosSimHead' : CosSimHead }
     if architecture in ('resnet-32', 'resnet-110', 'resnet-110-fc', 'resnet-110-wfc', 'pyramidnet-272-200', 'pyramidnet-110-270'):
-        return { 'ChannelPadding' : cifar_resnet.ChannelPadding }
-    else:
-        return {}
+        custom_objects['ChannelPadding'] = cifar_resnet.ChannelPadding
+    return custom_objects
 
 
 def get_lr_schedule(schedule, num_samples, batch_size, schedule_args = {}):
@@ -463,3 +525,87 @@ class TemplateModelCheckpoint(keras.callbacks.ModelCheckpoint):
                     self.tpl_model.save_weights(filepath, overwrite=True)
                 else:
                     self.tpl_model.save(filepath, overwrite=True)
+
+
+class AsyncModelCheckpoint(keras.callbacks.ModelCheckpoint):
+    """Saves the weights of a model after each epoch without blocking training.
+
+    The weights are copied synchronously at the end of the epoch and written to disk by a background
+    thread using a copy of the model kept on the CPU. Only the weights are stored (in HDF5 format), so
+    snapshots have to be restored with `load_weights()` on a model with the same architecture.
+
+    The callback has to be created outside of any distribution strategy scope.
+    Snapshots can only be saved at the end of each epoch (`save_freq='epoch'` and `period=1`).
+    """
+
+    def __init__(self, model, filepath, *args, **kwargs):
+
+        kwargs['save_weights_only'] = True
+        super(AsyncModelCheckpoint, self).__init__(filepath, *args, **kwargs)
+        if (getattr(self, 'save_freq', 'epoch') != 'epoch') or (getattr(self, 'period', 1) != 1):
+            raise ValueError('AsyncModelCheckpoint only supports saving snapshots after every epoch.')
+        # The copy of the model is created only once and receives the current weights for each snapshot.
+        with tf.device('/cpu:0'):
+            self.tpl_model = keras.models.clone_model(model)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self.pending = None
+
+
+    def on_epoch_end(self, epoch, logs=None):
+
+        logs = logs or {}
+        filepath = self.filepath.format(epoch=epoch + 1, **logs)
+        if self.save_best_only:
+            current = logs.get(self.monitor)
+            if current is None:
+                warnings.warn('Can save best model only with %s available, '
+                              'skipping.' % (self.monitor), RuntimeWarning)
+                return
+            if not self.monitor_op(current, self.best):
+                if self.verbose > 0:
+                    print('Epoch %05d: %s did not improve' %
+                          (epoch + 1, self.monitor))
+                return
+            if self.verbose > 0:
+                print('Epoch %05d: %s improved from %0.5f to %0.5f,'
+                      ' saving model to %s'
+                      % (epoch + 1, self.monitor, self.best,
+                         current, filepath))
+            self.best = current
+        elif self.verbose > 0:
+            print('Epoch %05d: saving model to %s' % (epoch + 1, filepath))
+        
+        weights = self.model.get_weights()
+        self.wait()
+        self.pending = self.executor.submit(self._write, filepath, weights)
+
+
+    def on_train_end(self, logs=None):
+
+        self.wait()
+
+
+    def wait(self):
+        """Blocks until the last snapshot has been written. """
+
+        if self.pending is not None:
+            try:
+                self.pending.result()
+            except Exception as e:
+                print('An error occurred while saving a snapshot: {}'.format(e))
+            self.pending = None
+
+
+    def _write(self, filepath, weights):
+
+        # Write to a temporary file first, so that an interrupted write does not destroy the previous snapshot.
+        # Its name is unique, so that concurrent runs writing to the same snapshot do not interfere with each other.
+        self.tpl_model.set_weights(weights)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(filepath)), suffix='.tmp', delete=False) as tmp_file:
+            tmp_filename = tmp_file.name
+        try:
+            self.tpl_model.save_weights(tmp_filename, overwrite=True, save_format='h5')
+            os.replace(tmp_filename, filepath)
+        except Exception:
+            os.remove(tmp_filename)
+            raise